@@ -10,15 +10,19 @@
 # Adapted from https://github.com/jadore801120/attention-is-all-you-need-pytorch under the MIT license.
 #   LICENSE is in incl_licenses directory.
 
-from einops import rearrange, repeat
-from einops_exts import rearrange_many
+import contextlib
 
 import numpy as np
 
 import torch
-from torch import einsum, nn
+from torch import nn
 import torch.nn.functional as F
 
+try:
+    from .window_attention import use_window_attention, window_attention
+except:
+    from window_attention import use_window_attention, window_attention
+
 def exists(val):
     return val is not None
 
@@ -27,7 +31,7 @@ def FeedForward(dim, mult=4):
     return nn.Sequential(
         nn.LayerNorm(dim),
         nn.Linear(dim, inner_dim, bias=False),
-        nn.GELU(),
+        nn.GELU(approximate='tanh'),
         nn.Linear(inner_dim, dim, bias=False),
     )
 
@@ -43,7 +47,19 @@ class ScaledDotProductAttention(nn.Module):
         self.temperature = temperature
         self.dropout = nn.Dropout(attn_dropout)
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, need_weights=False):
+
+        if not need_weights:
+            # Fused path (FlashAttention / memory-efficient kernels): the attention
+            # matrix is never materialized, so no weights are returned.
+            # The default SDPA scale 1/sqrt(d_k) equals 1/temperature.
+            attn_mask = None
+            if mask is not None:
+                attn_mask = torch.zeros_like(mask, dtype=q.dtype).masked_fill(mask == 0, float('-inf'))
+            output = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.0)
+            return output, None
 
         attn = torch.matmul(q / self.temperature, k.transpose(2, 3))
 
@@ -66,9 +82,8 @@ class MultiHeadAttention(nn.Module):
         self.d_k = d_k
         self.d_v = d_v
 
-        self.w_qs = nn.Linear(d_model, n_head * d_k, bias=False)
-        self.w_ks = nn.Linear(d_model, n_head * d_k, bias=False)
-        self.w_vs = nn.Linear(d_model, n_head * d_v, bias=False)
+        # q, k and v projections fused into one matrix: [w_qs; w_ks; w_vs]
+        self.w_qkv = nn.Linear(d_model, n_head * (2 * d_k + d_v), bias=False)
         self.fc = nn.Linear(n_head * d_v, d_model, bias=False)
 
         self.attention = ScaledDotProductAttention(temperature=d_k ** 0.5)
@@ -76,8 +91,14 @@ class MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # remap checkpoints saved with separate w_qs / w_ks / w_vs projections
+        keys = [prefix + name + '.weight' for name in ('w_qs', 'w_ks', 'w_vs')]
+        if all(key in state_dict for key in keys):
+            state_dict[prefix + 'w_qkv.weight'] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, need_weights=False):
 
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
         sz_b, len_q, len_k, len_v = q.size(0), q.size(1), k.size(1), v.size(1)
@@ -86,9 +107,17 @@ class MultiHeadAttention(nn.Module):
 
         # Pass through the pre-attention projection: b x lq x (n*dv)
         # Separate different heads: b x lq x n x dv
-        q = self.w_qs(q).view(sz_b, len_q, n_head, d_k)
-        k = self.w_ks(k).view(sz_b, len_k, n_head, d_k)
-        v = self.w_vs(v).view(sz_b, len_v, n_head, d_v)
+        split_sizes = [n_head * d_k, n_head * d_k, n_head * d_v]
+        if q is k and k is v:
+            # self-attention: one GEMM for all three projections
+            q, k, v = self.w_qkv(q).split(split_sizes, dim=-1)
+        else:
+            w_q, w_k, w_v = self.w_qkv.weight.split(split_sizes, dim=0)
+            q, k, v = F.linear(q, w_q), F.linear(k, w_k), F.linear(v, w_v)
+
+        q = q.view(sz_b, len_q, n_head, d_k)
+        k = k.view(sz_b, len_k, n_head, d_k)
+        v = v.view(sz_b, len_v, n_head, d_v)
 
         # Transpose for attention dot product: b x n x lq x dv
         q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
@@ -96,15 +125,15 @@ class MultiHeadAttention(nn.Module):
         if mask is not None:
             mask = mask.unsqueeze(1)   # For head axis broadcasting.
 
-        q, attn = self.attention(q, k, v, mask=mask)
+        q, attn = self.attention(q, k, v, mask=mask, need_weights=need_weights)
 
         # Transpose to move the head dimension back: b x lq x n x dv
         # Combine the last two dimensions to concatenate all the heads together: b x lq x (n*dv)
         q = q.transpose(1, 2).contiguous().view(sz_b, len_q, -1)
         q = self.dropout(self.fc(q))
-        q += residual
-
-        q = self.layer_norm(q)
+        q = F.layer_norm(
+            q + residual, self.layer_norm.normalized_shape,
+            self.layer_norm.weight, self.layer_norm.bias, self.layer_norm.eps)
 
         return q, attn
 
@@ -123,34 +152,39 @@ class PositionwiseFeedForward(nn.Module):
 
         residual = x
 
-        x = self.w_2(F.relu(self.w_1(x)))
-        x = self.dropout(x)
-        x += residual
-
-        x = self.layer_norm(x)
+        x = self.dropout(self.w_2(F.relu(self.w_1(x))))
 
-        return x
+        return F.layer_norm(
+            x + residual, self.layer_norm.normalized_shape,
+            self.layer_norm.weight, self.layer_norm.bias, self.layer_norm.eps)
 
 
 class PositionalEncoding(nn.Module):
 
     def __init__(self, d_hid, n_position=200):
         super(PositionalEncoding, self).__init__()
-        self.register_buffer('pos_table', self._get_sinusoid_encoding_table(n_position, d_hid))
+        # deterministic from the config, so it is not saved in checkpoints
+        self.register_buffer(
+            'pos_table', self._get_sinusoid_encoding_table(n_position, d_hid), persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints saved pos_table; drop it instead of reporting an unexpected key
+        state_dict.pop(prefix + 'pos_table', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def _get_sinusoid_encoding_table(self, n_position, d_hid):
 
-        def get_position_angle_vec(position):
-            return [position / np.power(10000, 2 * (hid_j // 2) / d_hid) for hid_j in range(d_hid)]
+        position = np.arange(n_position)[:, None]
+        hid_j = np.arange(d_hid)[None, :]
 
-        sinusoid_table = np.array([get_position_angle_vec(pos_i) for pos_i in range(n_position)])
+        sinusoid_table = position / np.power(10000, 2 * (hid_j // 2) / d_hid)
         sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
         sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
 
         return torch.FloatTensor(sinusoid_table).unsqueeze(0)
 
     def forward(self, x):
-        return x + self.pos_table[:, :x.size(1)].clone().detach()
+        return x + self.pos_table[:, :x.size(1)].to(x.dtype)
 
 
 class EncoderLayer(nn.Module):
@@ -161,9 +195,9 @@ class EncoderLayer(nn.Module):
         self.slf_attn = MultiHeadAttention(n_head, d_model, d_k, d_v, dropout=dropout)
         self.pos_ffn = PositionwiseFeedForward(d_model, d_inner, dropout=dropout)
 
-    def forward(self, enc_input, slf_attn_mask=None):
+    def forward(self, enc_input, slf_attn_mask=None, need_weights=False):
         enc_output, enc_slf_attn = self.slf_attn(
-            enc_input, enc_input, enc_input, mask=slf_attn_mask)
+            enc_input, enc_input, enc_input, mask=slf_attn_mask, need_weights=need_weights)
         enc_output = self.pos_ffn(enc_output)
         return enc_output, enc_slf_attn
 
@@ -173,7 +207,8 @@ class TransformerEncoder(nn.Module):
 
     def __init__(
             self, d_word_vec=512, n_layers=6, n_head=8, d_k=64, d_v=64,
-            d_model=512, d_inner=2048, dropout=0.0, n_position=16, scale_emb=True):
+            d_model=512, d_inner=2048, dropout=0.0, n_position=16, scale_emb=True,
+            torch_compile=False, amp_enabled=True):
 
         super().__init__()
 
@@ -185,9 +220,14 @@ class TransformerEncoder(nn.Module):
         self.layer_stack = nn.ModuleList([
             EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
+        if torch_compile:
+            # compile each block separately; wrapping forward keeps the state_dict keys unchanged
+            for enc_layer in self.layer_stack:
+                enc_layer.forward = torch.compile(enc_layer.forward, dynamic=False, mode="reduce-overhead")
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.scale_emb = scale_emb
         self.d_model = d_model
+        self.amp_enabled = amp_enabled
 
     def forward(self, src_seq, return_attns=False):
         if len(src_seq.shape) == 2:
@@ -196,17 +236,34 @@ class TransformerEncoder(nn.Module):
 
         enc_slf_attn_list = []
 
-        causal_mask = None
-
-        enc_output = src_seq
-        if self.scale_emb:
-            enc_output = enc_output * self.d_model ** 0.5
-        enc_output = self.dropout(self.position_enc(enc_output))
-        enc_output = self.layer_norm(enc_output)
+        # bf16 autocast for inference only; training follows the caller's precision setting
+        use_amp = (
+            self.amp_enabled and not self.training
+            and src_seq.is_cuda and torch.cuda.is_bf16_supported()
+        )
 
-        for enc_layer in self.layer_stack:
-            enc_output, enc_slf_attn = enc_layer(enc_output, slf_attn_mask=causal_mask)
-            enc_slf_attn_list += [enc_slf_attn] if return_attns else []
+        # no autocast context at all otherwise: a disabled one would switch off the caller's autocast
+        amp_context = torch.autocast("cuda", dtype=torch.bfloat16) if use_amp else contextlib.nullcontext()
+
+        with amp_context:
+            enc_output = src_seq
+            if self.scale_emb:
+                enc_output = enc_output * self.d_model ** 0.5
+            enc_output = self.dropout(self.position_enc(enc_output))
+            enc_output = self.layer_norm(enc_output)
+
+            # the encoder is unmasked: attn_mask stays None down to SDPA so the
+            # fastest (flash) kernel can be selected
+            if return_attns:
+                for enc_layer in self.layer_stack:
+                    enc_output, enc_slf_attn = enc_layer(enc_output, need_weights=True)
+                    enc_slf_attn_list += [enc_slf_attn]
+            else:
+                for enc_layer in self.layer_stack:
+                    enc_output, _ = enc_layer(enc_output)
+
+        # layer norms return fp32 under autocast; hand back the caller's dtype
+        enc_output = enc_output.to(src_seq.dtype)
 
         if return_attns:
             return enc_output, enc_slf_attn_list
@@ -224,6 +281,7 @@ class MaskedCrossAttention(nn.Module):
         dim_head=64,
         heads=8,
         only_attend_immediate_media=True,
+        use_window_attention=False,
     ):
         super().__init__()
         self.max_window_per_audio = max_window_per_audio
@@ -238,6 +296,7 @@ class MaskedCrossAttention(nn.Module):
         self.to_out = nn.Linear(inner_dim, dim, bias=False)
 
         self.only_attend_immediate_media = only_attend_immediate_media
+        self.use_window_attention = use_window_attention
 
     def forward(
         self, 
@@ -261,64 +320,55 @@ class MaskedCrossAttention(nn.Module):
         x = self.norm(x)
 
         q = self.to_q(x)
-        media = rearrange(media, "b t n d -> b (t n) d")
+        media = media.reshape(B, L, media.size(-1))  # n = 1 is extra dim
 
         k, v = self.to_kv(media).chunk(2, dim=-1)
-        q, k, v = rearrange_many((q, k, v), "b n (h d) -> b h n d", h=h)
-
-        q = q * self.scale
-
-        sim = einsum("... i d, ... j d -> ... i j", q, k)
+        q, k, v = (t.view(B, -1, h, t.size(-1) // h).transpose(1, 2) for t in (q, k, v))
 
         # mask padded audio embeddings
-        media_mask = rearrange(media_mask, "b i n -> b 1 1 (i n)").bool()  # n = 1 is extra dim
-        sim = sim.masked_fill(~media_mask, -torch.finfo(sim.dtype).max)
-
-        assert self.only_attend_immediate_media is False
+        media_mask = media_mask.reshape(B, 1, 1, -1).bool()  # n = 1 is extra dim
 
-        # mask media locations
         if exists(media_locations):
-            few_shot_mask = torch.zeros(B, T_txt, L).bool().to(sim.device)
-            for batch_idx in range(B): 
-                media_locations_b = media_locations[batch_idx].nonzero()  # locations of <audio>
-                if len(media_locations_b.shape) > 1:
-                    media_locations_b = media_locations_b.squeeze(-1)
-
-                for i in range(-1, len(media_locations_b)):
-                    if i == -1:
-                        if len(media_locations_b) == 1:
-                            text_start, text_end = 0, T_txt
-                        else:
-                            text_start, text_end = 0, media_locations_b[i+1]
-                    
-                    elif i == len(media_locations_b) - 1:
-                        text_start, text_end = media_locations_b[i], T_txt
-                    
-                    else:
-                        text_start, text_end = media_locations_b[i], media_locations_b[i+1]
-
-                    if self.only_attend_immediate_media:
-                        look_at_window_start = max(i,0) * self.max_window_per_audio
-                    else:
-                        look_at_window_start = 0
-                    look_at_window_end = (max(i,0) + 1) * self.max_window_per_audio
-                    
-                    few_shot_mask[batch_idx, text_start:text_end, look_at_window_start:look_at_window_end] = True
-
-            sim = sim.masked_fill(~few_shot_mask.unsqueeze(1), -torch.finfo(sim.dtype).max)
-
-        sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-        attn = sim.softmax(dim=-1)
-
-        if exists(media_locations) and self.only_attend_immediate_media:
-            text_without_media_mask = text_time == 0
-            text_without_media_mask = rearrange(
-                text_without_media_mask, "b i -> b 1 i 1"
-            )
-            attn = attn.masked_fill(text_without_media_mask, 0.0)
-
-        out = einsum("... i j, ... j d -> ... i d", attn, v)
-        out = rearrange(out, "b h n d -> b n (h d)")
+            # index of the <audio> window each text token belongs to;
+            # tokens before the first <audio> share window 0
+            text_window_id = (media_locations.long().cumsum(dim=1) - 1).clamp(min=0)  # B, T_txt
+            if use_cached_media:
+                # cached media_locations span the prompt, not the current text chunk
+                text_pos = torch.arange(T_txt, device=x.device).clamp(max=media_locations.shape[1] - 1)
+                text_window_id = text_window_id[:, text_pos]
+
+        out = None
+        if exists(media_locations) and use_window_attention(self.use_window_attention, q, k, v):
+            # block-sparse kernel (opt-in, inference only): only the audio windows visible
+            # to each text token are visited; returns None if the kernel cannot run here
+            out = window_attention(
+                q, k, v, text_window_id, media_mask.view(B, L),
+                self.max_window_per_audio, self.only_attend_immediate_media)
+            if out is None:
+                self.use_window_attention = False  # keep this layer on dense attention from now on
+
+        if out is None:
+            # single additive mask broadcast over heads, allocated once on device and filled in place;
+            # softmax stabilization is done inside SDPA
+            attn_mask = torch.zeros(
+                B, 1, T_txt if exists(media_locations) else 1, L, dtype=q.dtype, device=q.device)
+            attn_mask.masked_fill_(~media_mask, float('-inf'))
+
+            # mask media locations
+            if exists(media_locations):
+                media_window_id = torch.arange(L, device=x.device) // self.max_window_per_audio  # L
+
+                if self.only_attend_immediate_media:
+                    few_shot_mask = media_window_id[None, None, :] == text_window_id[:, :, None]
+                else:
+                    few_shot_mask = media_window_id[None, None, :] <= text_window_id[:, :, None]
+
+                attn_mask.masked_fill_(~few_shot_mask.unsqueeze(1), float('-inf'))
+
+            # default SDPA scale is dim_head ** -0.5 == self.scale
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+
+        out = out.transpose(1, 2).reshape(B, T_txt, -1)
         return self.to_out(out)
 
 
@@ -333,6 +383,7 @@ class GatedCrossAttentionBlock(nn.Module):
         heads=8,
         ff_mult=4,
         only_attend_immediate_media=True,
+        use_window_attention=False,
     ):
         super().__init__()
         self.attn = MaskedCrossAttention(
@@ -342,6 +393,7 @@ class GatedCrossAttentionBlock(nn.Module):
             dim_head=dim_head,
             heads=heads,
             only_attend_immediate_media=only_attend_immediate_media,
+            use_window_attention=use_window_attention,
         )
         self.attn_gate = nn.Parameter(torch.tensor([0.0]))
 
@@ -356,18 +408,16 @@ class GatedCrossAttentionBlock(nn.Module):
         media_locations=None,
         use_cached_media=False,
     ):
-        x = (
-            self.attn(
-                x,
-                media,
-                media_mask,
-                media_locations=media_locations,
-                use_cached_media=use_cached_media,
-            )
-            * self.attn_gate.tanh()
-            + x
+        # gated residuals as single fused multiply-adds: x + out * tanh(gate)
+        attn_out = self.attn(
+            x,
+            media,
+            media_mask,
+            media_locations=media_locations,
+            use_cached_media=use_cached_media,
         )
-        x = self.ff(x) * self.ff_gate.tanh() + x
+        x = torch.addcmul(x, attn_out, self.attn_gate.tanh())
+        x = torch.addcmul(x, self.ff(x), self.ff_gate.tanh())
 
         return x
 
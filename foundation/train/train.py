@@ -144,6 +144,7 @@ def main():
 
     # load pretrained model
     resume_from_epoch = 0
+    legacy_qkv_checkpoint = False
     if (resume_from_checkpoint is None) and (sft_config is not None):
         # just started SFT
         pretrained_path = os.path.join(
@@ -172,6 +173,10 @@ def main():
         msd = {k.replace("module.", ""): v for k, v in msd.items()}
         resume_from_epoch = checkpoint["epoch"] + 1
 
+        # checkpoints saved before w_qs / w_ks / w_vs were fused into w_qkv: the model weights
+        # are remapped on load, but the optimizer state no longer matches the parameters
+        legacy_qkv_checkpoint = any(k.endswith("slf_attn.w_qs.weight") for k in msd)
+
         # for fsdp, only one rank needs to load the state dict
         if not args.fsdp or args.rank == 0:
             model.load_state_dict(msd, False)
@@ -289,7 +294,15 @@ def main():
         )
 
     # load optimizer checkpoint
-    if resume_from_checkpoint is not None:
+    if resume_from_checkpoint is not None and legacy_qkv_checkpoint:
+        if args.rank == 0:
+            print(
+                "WARNING: checkpoint uses separate w_qs / w_ks / w_vs audio transformer weights; "
+                "skipping optimizer state, the optimizer restarts from scratch."
+            )
+        del checkpoint["optimizer_state_dict"]
+
+    elif resume_from_checkpoint is not None:
         osd = checkpoint["optimizer_state_dict"]
         if args.fsdp:
             osd = FSDP.optim_state_dict_to_load(osd, ddp_model, optimizer)
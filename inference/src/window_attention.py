@@ -0,0 +1,212 @@
+# Copyright (c) 2024 NVIDIA CORPORATION.
+#   Licensed under the MIT license.
+
+import warnings
+
+import torch
+import torch.nn.functional as F
+
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+
+if HAS_TRITON:
+    # failures that mean the kernel cannot run on this device / dtype (compilation, launch
+    # resources, unsupported device); OutOfResources moved from triton.compiler to triton.runtime
+    _KERNEL_ERRORS = (
+        RuntimeError,
+        triton.compiler.CompilationError,
+        getattr(triton.runtime, 'OutOfResources', getattr(triton.compiler, 'OutOfResources', RuntimeError)),
+    )
+
+
+if HAS_TRITON:
+
+    @triton.jit
+    def _window_attention_fwd_kernel(
+        Q, K, V, O, WID, KMASK,
+        stride_qb, stride_qh, stride_qm, stride_qd,
+        stride_kb, stride_kh, stride_kn, stride_kd,
+        stride_vb, stride_vh, stride_vn, stride_vd,
+        stride_ob, stride_oh, stride_om, stride_od,
+        stride_wb, stride_wm,
+        stride_mb, stride_mn,
+        H, T_txt, L, D, sm_scale,
+        WINDOW: tl.constexpr,
+        ONLY_IMMEDIATE: tl.constexpr,
+        BLOCK_M: tl.constexpr,
+        BLOCK_N: tl.constexpr,
+        BLOCK_D: tl.constexpr,
+    ):
+        pid_m = tl.program_id(0)
+        pid_bh = tl.program_id(1)
+        b = pid_bh // H
+        h = pid_bh % H
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_d = tl.arange(0, BLOCK_D)
+        m_valid = offs_m < T_txt
+        d_valid = offs_d < D
+
+        q = tl.load(
+            Q + b * stride_qb + h * stride_qh + offs_m[:, None] * stride_qm + offs_d[None, :] * stride_qd,
+            mask=m_valid[:, None] & d_valid[None, :], other=0.0)
+        wid = tl.load(WID + b * stride_wb + offs_m * stride_wm, mask=m_valid, other=0)
+
+        # only the key blocks covering the windows visible to this query block are visited
+        hi = tl.minimum((tl.max(wid, axis=0) + 1) * WINDOW, L)
+        if ONLY_IMMEDIATE:
+            lo = (tl.min(tl.where(m_valid, wid, 2147483647), axis=0) * WINDOW) // BLOCK_N * BLOCK_N
+        else:
+            lo = 0
+
+        m_i = tl.full([BLOCK_M], float("-inf"), dtype=tl.float32)
+        l_i = tl.zeros([BLOCK_M], dtype=tl.float32)
+        acc = tl.zeros([BLOCK_M, BLOCK_D], dtype=tl.float32)
+
+        for start_n in range(lo, hi, BLOCK_N):
+            offs_n = start_n + tl.arange(0, BLOCK_N)
+            n_valid = offs_n < L
+
+            k = tl.load(
+                K + b * stride_kb + h * stride_kh + offs_n[:, None] * stride_kn + offs_d[None, :] * stride_kd,
+                mask=n_valid[:, None] & d_valid[None, :], other=0.0)
+            s = tl.dot(q, tl.trans(k)) * sm_scale
+
+            key_valid = tl.load(KMASK + b * stride_mb + offs_n * stride_mn, mask=n_valid, other=0) != 0
+            key_window = offs_n // WINDOW
+            if ONLY_IMMEDIATE:
+                allowed = key_window[None, :] == wid[:, None]
+            else:
+                allowed = key_window[None, :] <= wid[:, None]
+            allowed = allowed & key_valid[None, :]
+            s = tl.where(allowed, s, float("-inf"))
+
+            # online softmax; rows with no visible key so far keep a zero contribution
+            m_new = tl.maximum(m_i, tl.max(s, axis=1))
+            m_safe = tl.where(m_new == float("-inf"), 0.0, m_new)
+            alpha = tl.exp(m_i - m_safe)
+            p = tl.exp(s - m_safe[:, None])
+            l_i = l_i * alpha + tl.sum(p, axis=1)
+
+            v = tl.load(
+                V + b * stride_vb + h * stride_vh + offs_n[:, None] * stride_vn + offs_d[None, :] * stride_vd,
+                mask=n_valid[:, None] & d_valid[None, :], other=0.0)
+            acc = acc * alpha[:, None] + tl.dot(p.to(v.dtype), v)
+            m_i = m_new
+
+        acc = acc / tl.where(l_i == 0.0, 1.0, l_i)[:, None]
+        tl.store(
+            O + b * stride_ob + h * stride_oh + offs_m[:, None] * stride_om + offs_d[None, :] * stride_od,
+            acc.to(O.dtype.element_ty), mask=m_valid[:, None] & d_valid[None, :])
+
+
+def window_attention_mask(text_window_id, media_mask, window_size, only_immediate, dtype):
+    """
+    Dense additive mask [B, 1, T_txt, L] equivalent to the window pattern used by the kernel.
+    """
+    L = media_mask.shape[-1]
+    media_window_id = torch.arange(L, device=media_mask.device) // window_size
+    if only_immediate:
+        valid = media_window_id[None, None, :] == text_window_id[:, :, None]
+    else:
+        valid = media_window_id[None, None, :] <= text_window_id[:, :, None]
+    valid = valid & media_mask[:, None, :].bool()
+
+    attn_mask = torch.zeros(valid.shape, dtype=dtype, device=valid.device)
+    return attn_mask.masked_fill_(~valid, float('-inf')).unsqueeze(1)
+
+
+class WindowAttention(torch.autograd.Function):
+    """
+    Cross attention from text tokens to their audio windows.
+
+    q: [B, H, T_txt, D], k, v: [B, H, L, D], text_window_id: [B, T_txt] index of the
+    last audio window visible to each text token, media_mask: [B, L] padded audio positions.
+    Only the key blocks inside the visible windows are visited. The kernel is forward-only:
+    training always takes the dense scaled_dot_product_attention path in MaskedCrossAttention.
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, v, text_window_id, media_mask, window_size, only_immediate):
+        B, H, T_txt, D = q.shape
+        L = k.shape[2]
+        text_window_id = text_window_id.to(torch.int32)
+        media_mask = media_mask.to(torch.int8)
+
+        o = torch.empty(B, H, T_txt, D, dtype=q.dtype, device=q.device)
+        BLOCK_M, BLOCK_N = 64, 64
+        BLOCK_D = max(16, triton.next_power_of_2(D))
+        grid = (triton.cdiv(T_txt, BLOCK_M), B * H)
+        _window_attention_fwd_kernel[grid](
+            q, k, v, o, text_window_id, media_mask,
+            *q.stride(), *k.stride(), *v.stride(), *o.stride(),
+            *text_window_id.stride(), *media_mask.stride(),
+            H, T_txt, L, D, D ** -0.5,
+            WINDOW=window_size, ONLY_IMMEDIATE=only_immediate,
+            BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N, BLOCK_D=BLOCK_D,
+        )
+
+        return o
+
+    @staticmethod
+    def backward(ctx, do):
+        raise RuntimeError(
+            "WindowAttention is forward-only; use dense attention when gradients are needed")
+
+
+def use_window_attention(enabled, q, k, v):
+    """
+    enabled is the calling module's use_window_attention flag. The kernel is used for
+    half-precision inference on CUDA only: fp32 tl.dot would run in TF32, and training keeps
+    the single dense SDPA forward / backward.
+    """
+    needs_grad = torch.is_grad_enabled() and any(t.requires_grad for t in (q, k, v))
+    return (
+        enabled and HAS_TRITON and q.is_cuda and not needs_grad
+        and q.dtype in (torch.float16, torch.bfloat16)
+    )
+
+
+def window_attention(q, k, v, text_window_id, media_mask, window_size, only_immediate=False):
+    """
+    Returns None if the kernel cannot run on this device / dtype, so the caller can fall back
+    to dense attention.
+    """
+    try:
+        return WindowAttention.apply(q, k, v, text_window_id, media_mask, window_size, only_immediate)
+    except _KERNEL_ERRORS as e:
+        warnings.warn(f"window attention kernel failed ({e}); falling back to dense attention")
+        return None
+
+
+if __name__ == '__main__':
+    # parity check of the kernel against window_attention_mask + SDPA
+    if not (HAS_TRITON and torch.cuda.is_available()):
+        print('skipped: needs triton and a CUDA device')
+    else:
+        torch.manual_seed(0)
+        B, H, T_txt, D, window_size = 2, 8, 100, 64, 16
+        L = 6 * window_size
+        media_locations = torch.zeros(B, T_txt, dtype=torch.bool)
+        media_locations[0, [3, 40, 80]] = True
+        media_locations[1, [0]] = True
+        text_window_id = (media_locations.long().cumsum(dim=1) - 1).clamp(min=0).cuda()
+        media_mask = torch.ones(B, L, dtype=torch.bool)
+        media_mask[0, -window_size + 3:] = False
+        media_mask[1, window_size + 5:] = False
+        media_mask = media_mask.cuda()
+
+        for dtype in (torch.float16, torch.bfloat16):
+            for only_immediate in (False, True):
+                q, k, v = (torch.randn(B, H, n, D, device='cuda', dtype=dtype) for n in (T_txt, L, L))
+                out = WindowAttention.apply(q, k, v, text_window_id, media_mask, window_size, only_immediate)
+                attn_mask = window_attention_mask(text_window_id, media_mask, window_size, only_immediate, dtype)
+                ref = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+                err = (out.float() - ref.float()).abs().max().item()
+                print(f'{dtype}, only_immediate={only_immediate}: max abs error {err:.2e}')
+                assert err < 2e-2, err